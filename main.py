@@ -1,10 +1,15 @@
-from flask import Flask, render_template, redirect, url_for, flash, abort
+from flask import Flask, render_template, redirect, url_for, flash, abort, request
 from flask_bootstrap import Bootstrap
 from datetime import date
 from flask_ckeditor import CKEditor
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_caching import Cache
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, selectinload, joinedload, lazyload, raiseload, load_only
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import event
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
 from flask_gravatar import Gravatar
@@ -20,8 +25,11 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("secret_key")
 
 ckeditor = CKEditor(app)
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 60})
 Bootstrap(app)
 
+password_hasher = PasswordHasher()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
@@ -32,7 +40,30 @@ gravatar = Gravatar(app, size=100, rating='g', default='retro',
 # CONNECT TO DB
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL",  "sqlite:///blog.db")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# Keeping connections open between requests instead of reconnecting every time
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 3600,
+}
+# SQLite file databases get NullPool by default, so asking for QueuePool explicitly
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'] = QueuePool
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'check_same_thread': False}
+# Objects stay usable after commit, so login_user and redirects don't reload the same row
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
+
+
+# SQLite settings for every new connection, WAL mode and bigger cache for faster reads
+if db.engine.dialect.name == "sqlite":
+    @event.listens_for(db.engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "cache_size=-64000",
+                       "temp_store=MEMORY", "mmap_size=268435456"):
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
 
 
 # CONFIGURE TABLES
@@ -41,12 +72,12 @@ class BlogPost(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
-    author = relationship("User", back_populates="posts")
-    comments = relationship("Comment", back_populates="parent_blog")
+    author = relationship("User", back_populates="posts", lazy="joined")
+    comments = relationship("Comment", back_populates="parent_blog", lazy="selectin")
 
 
 class User(UserMixin, db.Model):
@@ -64,12 +95,15 @@ class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.Text, nullable=False)
     commenter_id = db.Column(db.Integer, db.ForeignKey("users.id"))
-    writer = relationship("User", back_populates="comments")
-    blog_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
+    writer = relationship("User", back_populates="comments", lazy="joined")
+    blog_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"), index=True)
     parent_blog = relationship("BlogPost", back_populates="comments")
 
 
-db.create_all()
+# Creating tables once with "flask init-db" instead of on every start
+@app.cli.command('init-db')
+def init_db():
+    db.create_all()
 
 
 # Getting user information from database for login
@@ -78,26 +112,48 @@ def load_user(user_id):
     return User.query.get(int(user_id))
 
 
+# Checking password against argon2 hashes, older pbkdf2 hashes are still accepted
+def check_password(password_hash, password):
+    if password_hash.startswith("$argon2"):
+        try:
+            return password_hasher.verify(password_hash, password)
+        except (VerificationError, InvalidHash):
+            return False
+    return check_password_hash(password_hash, password)
+
+
+# Query helper, in debug mode any relationship that is not loaded explicitly raises instead of lazy loading
+def strict_query(model):
+    if app.debug:
+        return model.query.options(raiseload('*'))
+    return model.query
+
+
 # Some function works for only admin
 def admin_only(func):
     @wraps(func)
     def wrapper_function(*args, **kwargs):
-        try:
-            if current_user.id == 1:
-                return func(*args, **kwargs)
-            else:
-                return abort(403)
-        except AttributeError:
+        user = current_user
+        if not user.is_authenticated:
             return "<h1> need to log in first </h1>"
+        if user.id != 1:
+            return abort(403)
+        return func(*args, **kwargs)
     return wrapper_function
 
 
 # This is our homepage
 @app.route('/')
+@cache.cached(timeout=60, query_string=True, unless=lambda: current_user.is_authenticated)
 def get_all_posts():
-    posts = BlogPost.query.all()
-    users = User.query.all()
-    return render_template("index.html", all_posts=posts, users=users, logged_in=current_user.is_authenticated)
+    # Post bodies are not shown here, so leaving them in the database
+    posts = (strict_query(BlogPost)
+             .options(load_only(BlogPost.id, BlogPost.title, BlogPost.subtitle, BlogPost.img_url, BlogPost.date),
+                      joinedload(BlogPost.author), lazyload(BlogPost.comments))
+             .order_by(BlogPost.id.desc())
+             .paginate(page=request.args.get('page', 1, type=int), per_page=10))
+    return render_template("index.html", all_posts=posts.items, pagination=posts,
+                           logged_in=current_user.is_authenticated)
 
 
 # This is register page, grabs data from user and save it to DB
@@ -105,11 +161,14 @@ def get_all_posts():
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        if User.query.filter_by(email=form.email.data).first():
+        email_taken = db.session.query(
+            db.session.query(User.id).filter_by(email=form.email.data).exists()
+        ).scalar()
+        if email_taken:
             flash("That email already exist in db!")
             return redirect(url_for('login'))
         else:
-            hashed_password = generate_password_hash(form.password.data, method='pbkdf2:sha256', salt_length=8)
+            hashed_password = password_hasher.hash(form.password.data)
             new_user = User(name=form.name.data, email=form.email.data, password=hashed_password)
             db.session.add(new_user)
             db.session.commit()
@@ -123,10 +182,15 @@ def register():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
-        if user:
-            user_password = user.password
-            if check_password_hash(user_password, form.password.data):
+        row = db.session.query(User.id, User.password).filter_by(email=form.email.data).first()
+        if row:
+            if check_password(row.password, form.password.data):
+                # Loading the full user only after the password matches
+                user = User.query.get(row.id)
+                # Moving old pbkdf2 hashes to argon2 while we have the plain password
+                if not row.password.startswith("$argon2"):
+                    user.password = password_hasher.hash(form.password.data)
+                    db.session.commit()
                 login_user(user)
                 return redirect(url_for('get_all_posts'))
             else:
@@ -146,25 +210,43 @@ def logout():
 
 
 # Blog Posts web pages, getting data from database
+# Two queries per page, the post with its author and the comments with their writers
+def render_post_page(post_id, comment_form):
+    requested_post = (strict_query(BlogPost)
+                      .options(joinedload(BlogPost.author), lazyload(BlogPost.comments))
+                      .get_or_404(post_id))
+    blog_comments = (strict_query(Comment)
+                     .options(joinedload(Comment.writer))
+                     .filter_by(blog_id=post_id).all())
+    return render_template("post.html", post=requested_post, comment_form=comment_form,
+                           logged_in=current_user.is_authenticated, comments=blog_comments)
+
+
+# Same page for visitors, kept in cache until a comment is added or the post changes
+# Visitors can't comment, so no form is built and they get a login link instead
+@cache.memoize(60)
+def _render_post(post_id):
+    return render_post_page(post_id, None)
+
+
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
 def show_post(post_id):
-    requested_post = BlogPost.query.get(post_id)
-    users = User.query.all()
+    if request.method == "GET" and not current_user.is_authenticated:
+        return _render_post(post_id)
     comment_form = CommentForm()
     if comment_form.validate_on_submit():
         if not current_user.is_anonymous:
+            BlogPost.query.options(lazyload(BlogPost.comments)).get_or_404(post_id)
             new_comment = Comment(text=comment_form.comment.data, blog_id=post_id, commenter_id=current_user.id)
             db.session.add(new_comment)
             db.session.commit()
+            cache.delete_memoized(_render_post, post_id)
             return redirect(url_for("show_post", post_id=post_id))
         else:
             flash("Need to log in to comment!")
             return redirect(url_for('login'))
 
-    comments = Comment.query.all()
-    blog_comments = [ct for ct in comments if ct.blog_id == post_id]
-    return render_template("post.html", post=requested_post, users=users, comment_form=comment_form,
-                           logged_in=current_user.is_authenticated, comments=blog_comments)
+    return render_post_page(post_id, comment_form)
 
 
 # About page for club
@@ -191,10 +273,11 @@ def add_new_post():
             body=form.body.data,
             img_url=form.img_url.data,
             author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            date=date.today()
         )
         db.session.add(new_post)
         db.session.commit()
+        cache.clear()
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form, logged_in=current_user.is_authenticated)
 
@@ -203,7 +286,7 @@ def add_new_post():
 @app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = strict_query(BlogPost).options(joinedload(BlogPost.author), lazyload(BlogPost.comments)).get_or_404(post_id)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -217,6 +300,7 @@ def edit_post(post_id):
         post.img_url = edit_form.img_url.data
         post.body = edit_form.body.data
         db.session.commit()
+        cache.clear()
         return redirect(url_for("show_post", post_id=post.id))
 
     return render_template("make-post.html", form=edit_form, logged_in=current_user.is_authenticated)
@@ -226,9 +310,10 @@ def edit_post(post_id):
 @app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = strict_query(BlogPost).options(selectinload(BlogPost.comments)).get_or_404(post_id)
     db.session.delete(post_to_delete)
     db.session.commit()
+    cache.clear()
     return redirect(url_for('get_all_posts'))
 
 
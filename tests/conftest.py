@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import date
+
+import pytest
+from sqlalchemy import event
+
+# main.py reads DATABASE_URL when imported, so pointing it to a temporary SQLite file first
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+# App with fresh tables, posts by different authors and comments by users other than the post author,
+# so every lazy loaded author or writer would cost its own statement
+@pytest.fixture
+def app():
+    main.app.config.update(TESTING=True, SECRET_KEY="test", WTF_CSRF_ENABLED=False)
+    main.app.debug = False
+    with main.app.app_context():
+        main.db.create_all()
+        users = [main.User(name=f"User {n}", email=f"user{n}@example.com", password="not-a-hash")
+                 for n in range(1, 5)]
+        posts = [main.BlogPost(title=f"Test Post {n}", subtitle="Subtitle", date=date(2022, 12, 9),
+                               body="<p>Body</p>", img_url="https://example.com/img.jpg", author=users[n - 1])
+                 for n in range(1, 4)]
+        comments = [main.Comment(text=f"<p>Comment {n}</p>", writer=users[n], parent_blog=posts[0])
+                    for n in range(1, 4)]
+        main.db.session.add_all(users + posts + comments)
+        main.db.session.commit()
+        main.db.session.remove()
+    main.cache.clear()
+
+    yield main.app
+
+    main.app.debug = False
+    with main.app.app_context():
+        main.db.session.remove()
+        main.db.drop_all()
+    main.cache.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# Collecting SQL statements run inside the block
+# with count_queries() as statements: client.get('/')
+@pytest.fixture
+def count_queries(app):
+    @contextmanager
+    def counter():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(main.db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(main.db.engine, "before_cursor_execute", before_cursor_execute)
+    return counter
@@ -0,0 +1,39 @@
+# Upper bounds on SQL statements per page, so lazy loading (N+1) can't come back unnoticed
+
+
+def log_in(client, user_id):
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
+
+
+def test_homepage_query_count(client, count_queries):
+    with count_queries() as statements:
+        response = client.get("/")
+    assert response.status_code == 200
+    assert len(statements) <= 2, statements
+
+
+def test_post_page_query_count(client, count_queries):
+    with count_queries() as statements:
+        response = client.get("/post/1")
+    assert response.status_code == 200
+    assert len(statements) <= 2, statements
+
+
+# Logged in users skip the cached page, one more statement for loading the user
+def test_logged_in_post_page_query_count(client, count_queries):
+    log_in(client, 1)
+    with count_queries() as statements:
+        response = client.get("/post/1")
+    assert response.status_code == 200
+    assert len(statements) <= 3, statements
+
+
+# In debug mode strict_query raises on any relationship the views didn't load explicitly
+def test_pages_load_without_lazy_loads_in_debug(app, client):
+    app.debug = True
+    assert client.get("/").status_code == 200
+    assert client.get("/post/1").status_code == 200
+    log_in(client, 1)
+    assert client.get("/post/1").status_code == 200